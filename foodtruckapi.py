@@ -6,6 +6,8 @@ Features:
     -Allows filtering by type, status, fooditems etc.
     -Allows sorting by name, distance
     -Allows specifying offsets and limits
+    -Allows filtering by trucks open now or at a given time
+    -Allows counting foodtrucks per map grid cell for clustering and heatmaps
 """
 import re
 import ConfigParser
@@ -20,11 +22,16 @@ from geopy.distance import vincenty
 from geoip import geolite2
 from copy import copy
 from foodtruckexceptions import MissingParameterError, InternalServerError, InvalidParameterError
+from foodtruckschedule import schedule_index, get_slot, parse_time
+from foodtruckgrid import grid_index, get_zoom_for_bounds, get_zoom_for_cell_size, get_cell_size, get_tiles, \
+    MIN_ZOOM, MAX_ZOOM
 import tornado.web
 import tornado.httpserver
 import tornado.ioloop
 
 HTTP_DOCS_ROOT = "html"
+#seconds between rebuilds of the schedule and grid indexes from the database, can be set via -reload
+INDEX_RELOAD_INTERVAL = 300
 
 #loglevel can also be adjusted from commandline via -loglevel parameter
 log = logging.getLogger("food_truck_logger")
@@ -83,6 +90,8 @@ class FoodTrucks(tornado.web.RequestHandler):
             self._config.set('Query Options', 'name', json.dumps(None))
             self._config.set('Query Options', 'status', json.dumps(None))
             self._config.set('Query Options', 'fooditems', json.dumps(None))
+            self._config.set('Query Options', 'open_now', json.dumps(None))
+            self._config.set('Query Options', 'open_at', json.dumps(None))
             with open(self._config_file, 'w') as configfile:
                 self._config.write(configfile)
 
@@ -250,6 +259,7 @@ class NearbyFoodTruckHandler(FoodTrucks):
 
             if self.query_parameter['status']:
                 query['status'] = self.query_parameter['status']
+            self.add_open_filter(query)
         except Exception as e:
             log.error("[NearbyFoodTruckHandler] Error generating bounds query: {0}".format(str(e)))
             raise InternalServerError("Error generating query")
@@ -306,6 +316,7 @@ class NearbyFoodTruckHandler(FoodTrucks):
                 query["facilitytype"] = self.query_parameter["category_filter"]
             if self.query_parameter["status"]:
                 query["status"] = self.query_parameter["status"]
+            self.add_open_filter(query)
         except Exception as e:
             log.error("[NearbyFoodTruckHandler] Error generating near point query: {0}".format(str(e)))
             raise e
@@ -318,6 +329,35 @@ class NearbyFoodTruckHandler(FoodTrucks):
         else:
             return list(geo_query_result)
 
+    def get_open_slot(self):
+        """Get week slot for open_now=1 or open_at=time eg: open_at=14:30 or open_at=Sa%2014:30
+        @return:    slot number within the week, None if no time filter was requested
+        """
+        log.debug("[NearbyFoodTruckHandler] Get open slot")
+        open_now = self.query_parameter.get("open_now") and str(self.query_parameter["open_now"]) != "0"
+        if open_now and self.query_parameter.get("open_at"):
+            raise InvalidParameterError("both open_now and open_at specified, cannot disambiguate")
+        if self.query_parameter.get("open_at"):
+            try:
+                return parse_time(self.query_parameter["open_at"])
+            except ValueError as e:
+                log.warning("[NearbyFoodTruckHandler] Invalid open_at: {0}".format(str(e)))
+                raise InvalidParameterError("open_at should be HH:MM or Day HH:MM eg: Sa 14:30")
+        if open_now:
+            return get_slot()
+        return None
+
+    def add_open_filter(self, query):
+        """Restrict query to foodtrucks open during the requested slot, so limit applies after filtering
+        @param query:   MongoDB query to update
+        """
+        slot = self.query_parameter.get("open_slot")
+        if slot is None:
+            return
+        if not schedule_index.loaded:
+            schedule_index.load(self.foodtrucks)
+        query["objectid"] = {"$in": schedule_index.open_ids(slot)}
+
     def get_all_nearby_foodtrucks(self):
         """Helper to delegate query to bounds or point functions. Also sorts/filters results
         """
@@ -355,6 +395,8 @@ class NearbyFoodTruckHandler(FoodTrucks):
                 log.warning("[NearbyFoodTruckHandler] Invalid query parameters")
                 raise InvalidParameterError("multiple locations specified, cannot disambiguate")
         else:
+            #open_now resolves to the current slot, it is part of the cache key so results do not go stale
+            self.query_parameter["open_slot"] = self.get_open_slot()
             #check cache
             resultlist = self.get_cache()
             if resultlist is not None:
@@ -407,6 +449,116 @@ class NearbyFoodTruckHandler(FoodTrucks):
             self.write(response)
 
 
+class FoodTruckAggregateHandler(NearbyFoodTruckHandler):
+    """Handler for counting foodtrucks per grid cell within bounds
+    """
+    def initialize(self):
+        log.debug("[FoodTruckAggregateHandler] Initializing")
+        super(FoodTruckAggregateHandler, self).initialize()
+
+    def get_zoom(self, latitude, longitude):
+        """Get zoom from zoom or cell_size (degrees) parameter, else derive it from bounds
+        @param latitude:    dict of sw, ne latitude
+        @param longitude:   dict of sw, ne longitude
+        @return:    zoom level
+        """
+        log.debug("[FoodTruckAggregateHandler] Get zoom")
+        try:
+            if self.query_parameter.get("zoom") is not None:
+                zoom = int(self.query_parameter["zoom"])
+            elif self.query_parameter.get("cell_size") is not None:
+                zoom = get_zoom_for_cell_size(float(self.query_parameter["cell_size"]))
+            else:
+                zoom = get_zoom_for_bounds(latitude, longitude)
+        except (ValueError, ZeroDivisionError) as e:
+            log.warning("[FoodTruckAggregateHandler] Invalid zoom: {0}".format(str(e)))
+            raise InvalidParameterError("zoom should be a number, cell_size a positive number")
+        if zoom < MIN_ZOOM or zoom > MAX_ZOOM:
+            raise InvalidParameterError("zoom should be between {0} and {1}".format(MIN_ZOOM, MAX_ZOOM))
+        return zoom
+
+    def get_fooditems_regex(self):
+        """Compile fooditems regex once for all tiles
+        @return:    compiled regex or None
+        """
+        if not self.query_parameter["fooditems"]:
+            return None
+        try:
+            return re.compile(self.query_parameter["fooditems"], re.IGNORECASE)
+        except re.error as e:
+            log.warning("[FoodTruckAggregateHandler] Invalid fooditems: {0}".format(str(e)))
+            raise InvalidParameterError("fooditems is not a valid pattern")
+
+    def get_tile_cache_key(self, zoom, tile):
+        """Cache key for a tile. Does not depend on bounds so neighbouring requests share tiles
+        @param zoom:    zoom level
+        @param tile:    x, y of tile
+        @return:    key string
+        """
+        return json.dumps(["aggregate", grid_index.version, zoom, tile, self.query_parameter["category_filter"],
+                           self.query_parameter["status"], self.query_parameter["fooditems"]])
+
+    def get_tile(self, zoom, tile, fooditems_regex):
+        """Check cache for tile, aggregate from grid index and put in cache if needed
+        @param zoom:    zoom level
+        @param tile:    x, y of tile
+        @param fooditems_regex: compiled fooditems regex or None
+        @return:    list of cell dicts in tile
+        """
+        key = self.get_tile_cache_key(zoom, tile)
+        try:
+            cells = json.loads(self.cache.get(key))
+        except Exception:
+            cells = None
+        if cells is not None:
+            log.debug("[FoodTruckAggregateHandler] tile cache hit. Key={0}".format(key))
+            return cells
+        log.debug("[FoodTruckAggregateHandler] tile cache miss. Key={0}".format(key))
+        cells = grid_index.aggregate_tile(zoom, tile, self.query_parameter["category_filter"],
+                                          self.query_parameter["status"], fooditems_regex)
+        try:
+            self.cache.set(key, json.dumps(cells))
+        except Exception as e:
+            log.warning("[FoodTruckAggregateHandler] Unable to put tile in cache: {0}".format(str(e)))
+        return cells
+
+    def search_food_truck(self):
+        """Collect cells of all tiles covering bounds. Replaces the truck search used by get
+        @return:    dict with zoom, cell_size and list of cells within bounds
+        """
+        if not self.query_parameter["bounds"]:
+            raise MissingParameterError("bounds field is missing in query")
+        if self.query_parameter["location"] or self.query_parameter["point"]:
+            log.warning("[FoodTruckAggregateHandler] Invalid query parameters")
+            raise InvalidParameterError("multiple locations specified, cannot disambiguate")
+        try:
+            latitude, longitude = self.get_location_coordinates()
+        except Exception as e:
+            log.error("[FoodTruckAggregateHandler] Unable to find coordinates: {0}".format(str(e)))
+            raise InvalidParameterError("Unable to find location")
+        if len(latitude) != 2:
+            raise InvalidParameterError("bounds should be sw_latitude,sw_longitude|ne_latitude,ne_longitude")
+
+        zoom = self.get_zoom(latitude, longitude)
+        fooditems_regex = self.get_fooditems_regex()
+        try:
+            tiles, (min_x, min_y, max_x, max_y) = get_tiles(latitude, longitude, zoom)
+        except ValueError as e:
+            log.warning("[FoodTruckAggregateHandler] {0}".format(str(e)))
+            raise InvalidParameterError("bounds too large for zoom, use a lower zoom or larger cell_size")
+
+        try:
+            if not grid_index.loaded:
+                grid_index.load(self.foodtrucks)
+            cells = []
+            for tile in tiles:
+                cells.extend(cell for cell in self.get_tile(zoom, tile, fooditems_regex)
+                             if min_x <= cell["cell"][0] <= max_x and min_y <= cell["cell"][1] <= max_y)
+        except Exception as e:
+            log.error("[FoodTruckAggregateHandler] Unexpected error occurred: {0}".format(str(e)))
+            raise InternalServerError("Unexpected internal server error")
+        return {"zoom": zoom, "cell_size": get_cell_size(zoom), "cells": cells}
+
 class FoodTruckInfoHandler(FoodTrucks):
     """Handles individual requests
     """
@@ -487,6 +639,17 @@ class FoodTruckInfoHandler(FoodTrucks):
             response = self.generate_response(resultlist)
             self.write(response)
 
+def load_indexes():
+    """(Re)build schedule and grid indexes from the database so they follow data reloads
+    """
+    log.info("Building schedule and grid indexes")
+    try:
+        foodtrucks = MongoClient().test.foodtrucks
+        schedule_index.load(foodtrucks)
+        grid_index.load(foodtrucks)
+    except Exception as e:
+        log.error("Error building indexes: {0}".format(str(e)))
+
 if __name__ == "__main__":
     bindport = 4545
     bindhost = "0.0.0.0"
@@ -496,6 +659,7 @@ if __name__ == "__main__":
     parser.add_argument("-http", help="host:port for http connections")
     parser.add_argument("-https", help="host:port for https connections")
     parser.add_argument("-loglevel", help="logging level for module", type=int)
+    parser.add_argument("-reload", help="seconds between index rebuilds from the database", type=int)
     args = parser.parse_args()
 
     if args.loglevel:
@@ -509,6 +673,7 @@ if __name__ == "__main__":
 
     application = tornado.web.Application([
         (r"/searchfood", NearbyFoodTruckHandler),
+        (r"/searchfood/aggregate", FoodTruckAggregateHandler),
         (r"/foodtruck", FoodTruckInfoHandler),
         (r"/(.+)", APIDocsHtmlStaticFileHandler, {'path': HTTP_DOCS_ROOT}),
     ])
@@ -520,6 +685,10 @@ if __name__ == "__main__":
 
     http_server = tornado.httpserver.HTTPServer(application)
 
+    load_indexes()
+    #rebuild on the ioloop so a refreshed collection reaches open_now/open_at and aggregate results
+    tornado.ioloop.PeriodicCallback(load_indexes, (args.reload or INDEX_RELOAD_INTERVAL) * 1000).start()
+
     log.info("Starting web application: http/https servers and ioloop")
 
     https_server.listen(sslport, sslhost)
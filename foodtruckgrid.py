@@ -0,0 +1,170 @@
+"""
+Multi resolution grid of foodtruck locations used for map clustering and heatmaps.
+At every zoom level the world is split into square cells of 360/2^zoom degrees and
+every truck is bucketed into its cell when the data is loaded. Cells are grouped into
+tiles of TILE_SIZE x TILE_SIZE cells, which is the unit aggregated and cached per request.
+"""
+import math
+import hashlib
+import logging
+from collections import defaultdict
+
+log = logging.getLogger("food_truck_logger")
+
+MIN_ZOOM = 0
+MAX_ZOOM = 20
+TILE_SHIFT = 3
+TILE_SIZE = 1 << TILE_SHIFT
+#Default zoom aims for roughly this many cells across the requested bounds
+DEFAULT_CELLS_ACROSS = 16
+MAX_CELLS = 4096
+
+
+def get_cell_size(zoom):
+    """Get cell edge length for zoom
+    @param zoom:    zoom level
+    @return:    cell size in degrees
+    """
+    return 360.0 / (1 << zoom)
+
+
+def get_zoom_for_cell_size(cell_size):
+    """Get the coarsest zoom whose cells are not larger than cell_size
+    @param cell_size:   cell size in degrees
+    @return:    zoom level
+    """
+    zoom = int(math.ceil(math.log(360.0 / cell_size, 2)))
+    return min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+
+
+def get_zoom_for_bounds(latitude, longitude):
+    """Get a zoom giving about DEFAULT_CELLS_ACROSS cells across the bounds
+    @param latitude:    dict of sw, ne latitude
+    @param longitude:   dict of sw, ne longitude
+    @return:    zoom level
+    """
+    span = max(abs(latitude[1] - latitude[0]), abs(longitude[1] - longitude[0]))
+    if not span:
+        return MAX_ZOOM
+    return get_zoom_for_cell_size(span / DEFAULT_CELLS_ACROSS)
+
+
+def get_cell(latitude, longitude, zoom):
+    """Get cell containing a point
+    @param latitude:    latitude of point
+    @param longitude:   longitude of point
+    @param zoom:    zoom level
+    @return:    x, y of cell
+    """
+    cell_size = get_cell_size(zoom)
+    return int(math.floor((longitude + 180) / cell_size)), int(math.floor((latitude + 90) / cell_size))
+
+
+def get_cell_bounds(cell, zoom):
+    """Get bounds of a cell in the same format as the bounds query parameter
+    @param cell:    x, y of cell
+    @param zoom:    zoom level
+    @return:    "sw_latitude,sw_longitude|ne_latitude,ne_longitude"
+    """
+    cell_size = get_cell_size(zoom)
+    sw_latitude, sw_longitude = cell[1] * cell_size - 90, cell[0] * cell_size - 180
+    return "{0},{1}|{2},{3}".format(sw_latitude, sw_longitude, sw_latitude + cell_size, sw_longitude + cell_size)
+
+
+def get_tiles(latitude, longitude, zoom):
+    """Get tiles covering the bounds
+    @param latitude:    dict of sw, ne latitude
+    @param longitude:   dict of sw, ne longitude
+    @param zoom:    zoom level
+    @return:    list of tiles and (min x, min y, max x, max y) cell range of the bounds
+    """
+    sw_x, sw_y = get_cell(min(latitude.values()), min(longitude.values()), zoom)
+    ne_x, ne_y = get_cell(max(latitude.values()), max(longitude.values()), zoom)
+    if (ne_x - sw_x + 1) * (ne_y - sw_y + 1) > MAX_CELLS:
+        raise ValueError("Too many cells for bounds at zoom {0}".format(zoom))
+    tiles = [(tile_x, tile_y)
+             for tile_x in range(sw_x >> TILE_SHIFT, (ne_x >> TILE_SHIFT) + 1)
+             for tile_y in range(sw_y >> TILE_SHIFT, (ne_y >> TILE_SHIFT) + 1)]
+    return tiles, (sw_x, sw_y, ne_x, ne_y)
+
+
+class GridIndex(object):
+    """Per zoom level buckets of foodtrucks: zoom -> tile -> cell -> cell data.
+    Cell data keeps the trucks in the cell and per (facilitytype, status) count and
+    coordinate sums, so unfiltered or category/status filtered counts need no scan.
+    """
+    def __init__(self):
+        self.levels = {}
+        self.version = None
+        self.loaded = False
+
+    def load(self, collection):
+        """(Re)build the grid from the foodtruck collection. Called at startup and periodically by the server
+        @param collection:  MongoDB foodtrucks collection
+        """
+        log.info("[GridIndex] Building grid index")
+        levels = {}
+        entries = []
+        for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+            levels[zoom] = defaultdict(dict)
+        for foodtruck in collection.find({"loc": {"$exists": True}},
+                                         {"loc": 1, "facilitytype": 1, "status": 1, "fooditems": 1}):
+            try:
+                longitude, latitude = float(foodtruck["loc"][0]), float(foodtruck["loc"][1])
+            except (ValueError, TypeError, IndexError) as e:
+                log.warning("[GridIndex] Invalid loc for {0}: {1}".format(foodtruck.get("_id"), str(e)))
+                continue
+            truck = (latitude, longitude, foodtruck.get("facilitytype"), foodtruck.get("status"),
+                     foodtruck.get("fooditems") or "")
+            entries.append((str(foodtruck.get("_id")),) + truck)
+            for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+                cell = get_cell(latitude, longitude, zoom)
+                tile = (cell[0] >> TILE_SHIFT, cell[1] >> TILE_SHIFT)
+                data = levels[zoom][tile].setdefault(cell, {"trucks": [], "stats": {}})
+                data["trucks"].append(truck)
+                stats = data["stats"].setdefault((truck[2], truck[3]), [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += latitude
+                stats[2] += longitude
+        self.levels = levels
+        #version is a hash of the data and part of tile cache keys, so tiles cached for other data,
+        #eg: before a data refresh and restart, are never reused while every server process agrees on it
+        self.version = hashlib.md5(repr(sorted(entries))).hexdigest()
+        self.loaded = True
+
+    def aggregate_tile(self, zoom, tile, category_filter=None, status=None, fooditems_regex=None):
+        """Count foodtrucks and their centroid for every non empty cell in a tile
+        @param zoom:    zoom level
+        @param tile:    x, y of tile
+        @param category_filter: exact facilitytype to count
+        @param status:  exact permit status to count
+        @param fooditems_regex: compiled fooditems regex to count
+        @return:    list of cell dicts
+        """
+        result = []
+        for cell, data in self.levels[zoom].get(tile, {}).iteritems():
+            count, sum_latitude, sum_longitude = 0, 0.0, 0.0
+            if fooditems_regex:
+                for latitude, longitude, facilitytype, truck_status, truck_fooditems in data["trucks"]:
+                    if ((category_filter and facilitytype != category_filter)
+                            or (status and truck_status != status)
+                            or not fooditems_regex.search(truck_fooditems)):
+                        continue
+                    count += 1
+                    sum_latitude += latitude
+                    sum_longitude += longitude
+            else:
+                for (facilitytype, truck_status), stats in data["stats"].iteritems():
+                    if (category_filter and facilitytype != category_filter) or (status and truck_status != status):
+                        continue
+                    count += stats[0]
+                    sum_latitude += stats[1]
+                    sum_longitude += stats[2]
+            if count:
+                result.append({"cell": list(cell), "count": count,
+                               "centroid": [sum_longitude / count, sum_latitude / count],
+                               "bounds": get_cell_bounds(cell, zoom)})
+        return result
+
+
+grid_index = GridIndex()
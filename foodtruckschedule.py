@@ -0,0 +1,158 @@
+"""
+Weekly opening hours index for foodtrucks.
+The permit "dayshours" text (eg: "Mo-Fr:10AM-3PM;Sa/Su:11AM-6PM") is parsed once when
+the data is loaded into a per-truck bitmap of 15 minute slots over the week, from which
+the trucks open in every slot are precomputed. A time filter is then a list lookup that
+is passed to the geo query as an objectid $in.
+All times are San Francisco local time regardless of the server timezone.
+"""
+import re
+import logging
+import pytz
+from datetime import datetime
+
+log = logging.getLogger("food_truck_logger")
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 / SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+DAYS = ["mo", "tu", "we", "th", "fr", "sa", "su"]
+TIMEZONE = pytz.timezone("America/Los_Angeles")
+
+days_hours_pattern = re.compile(r"^\s*([A-Za-z/\-\s]+?)\s*:\s*(.+?)\s*$")
+hour_pattern = re.compile(r"^\s*(\d{1,2})(?::(\d{2}))?\s*([AaPp][Mm])\s*$")
+time_pattern = re.compile(r"^\s*(?:([A-Za-z]{2})[A-Za-z]*\s+)?(\d{1,2}):(\d{2})\s*$")
+
+
+def parse_days(days):
+    """Parse day part of dayshours eg: "Mo-Fr" or "Mo/We/Fr"
+    @param days:    day string
+    @return:    list of weekday numbers, monday is 0
+    """
+    weekdays = []
+    for part in days.lower().split("/"):
+        bounds = [day.strip()[:2] for day in part.split("-")]
+        start = DAYS.index(bounds[0])
+        end = DAYS.index(bounds[-1])
+        #ranges like Fr-Mo wrap around the week
+        weekdays.extend((start + offset) % 7 for offset in range((end - start) % 7 + 1))
+    return weekdays
+
+
+def parse_hour(hour):
+    """Parse a 12 hour clock time eg: "10AM" or "10:30PM"
+    @param hour:    time string
+    @return:    minutes since midnight
+    """
+    match = hour_pattern.match(hour)
+    if not match:
+        raise ValueError("Invalid hour {0}".format(hour))
+    hours = int(match.group(1)) % 12
+    minutes = int(match.group(2) or 0)
+    if match.group(3).upper() == "PM":
+        hours += 12
+    return hours * 60 + minutes
+
+
+def parse_dayshours(dayshours):
+    """Parse permit dayshours text into a weekly bitmap
+    @param dayshours:   text like "Mo-Fr:10AM-3PM;Sa/Su:11AM-6PM"
+    @return:    int with bit n set if truck is open during slot n of the week
+    """
+    bitmap = 0
+    for group in dayshours.split(";"):
+        if not group.strip():
+            continue
+        match = days_hours_pattern.match(group)
+        if not match:
+            raise ValueError("Invalid dayshours {0}".format(group))
+        weekdays = parse_days(match.group(1))
+        for hours in match.group(2).split("/"):
+            start, end = [parse_hour(hour) for hour in hours.split("-")]
+            start_slot = start / SLOT_MINUTES
+            #closing time is exclusive, 12AM-12AM means the whole day
+            end_slot = (end + SLOT_MINUTES - 1) / SLOT_MINUTES
+            if end_slot <= start_slot:
+                end_slot += SLOTS_PER_DAY
+            for weekday in weekdays:
+                for slot in range(start_slot, end_slot):
+                    bitmap |= 1 << ((weekday * SLOTS_PER_DAY + slot) % SLOTS_PER_WEEK)
+    return bitmap
+
+
+def get_local_time(when=None):
+    """Convert a datetime to San Francisco time
+    @param when:    timezone aware datetime, defaults to now
+    @return:    datetime in San Francisco timezone
+    """
+    when = when or datetime.utcnow().replace(tzinfo=pytz.utc)
+    return when.astimezone(TIMEZONE)
+
+
+def get_slot(when=None):
+    """Get the week slot for a datetime
+    @param when:    timezone aware datetime, defaults to now
+    @return:    slot number within the week in San Francisco time
+    """
+    when = get_local_time(when)
+    return when.weekday() * SLOTS_PER_DAY + (when.hour * 60 + when.minute) / SLOT_MINUTES
+
+
+def parse_time(value, now=None):
+    """Parse open_at value eg: "14:30" (today) or "Sa 14:30"
+    @param value:   time string
+    @param now: timezone aware datetime used to get the weekday when it is not given, defaults to now
+    @return:    slot number within the week
+    """
+    match = time_pattern.match(value)
+    if not match:
+        raise ValueError("Invalid time {0}".format(value))
+    hours, minutes = int(match.group(2)), int(match.group(3))
+    if hours > 23 or minutes > 59:
+        raise ValueError("Invalid time {0}".format(value))
+    if match.group(1):
+        weekday = DAYS.index(match.group(1).lower())
+    else:
+        weekday = get_local_time(now).weekday()
+    return weekday * SLOTS_PER_DAY + (hours * 60 + minutes) / SLOT_MINUTES
+
+
+class ScheduleIndex(object):
+    """Maps every 15 minute slot of the week to the foodtruck objectids open during it
+    """
+    def __init__(self):
+        self.slots = [[] for slot in range(SLOTS_PER_WEEK)]
+        self.loaded = False
+
+    def load(self, collection):
+        """(Re)build the index from the foodtruck collection. Called at startup and periodically by the server
+        @param collection:  MongoDB foodtrucks collection
+        """
+        log.info("[ScheduleIndex] Building schedule index")
+        bitmaps = {}
+        for foodtruck in collection.find({}, {"objectid": 1, "dayshours": 1}):
+            if not foodtruck.get("dayshours"):
+                continue
+            try:
+                bitmaps[foodtruck["objectid"]] = parse_dayshours(foodtruck["dayshours"])
+            except (ValueError, KeyError) as e:
+                log.warning("[ScheduleIndex] Unable to parse dayshours for {0}: {1}".format(
+                    foodtruck.get("objectid"), str(e)))
+        #slot -> open objectids, so a time filter needs no scan of the bitmaps
+        slots = [[] for slot in range(SLOTS_PER_WEEK)]
+        for objectid, bitmap in bitmaps.iteritems():
+            for slot in range(SLOTS_PER_WEEK):
+                if bitmap >> slot & 1:
+                    slots[slot].append(objectid)
+        self.slots = slots
+        self.loaded = True
+
+    def open_ids(self, slot):
+        """Get all foodtrucks open during slot
+        @param slot:    slot number within the week
+        @return:    list of objectids. Trucks without known hours are never open
+        """
+        return self.slots[slot]
+
+
+schedule_index = ScheduleIndex()
@@ -1,6 +1,11 @@
 from tornado.testing import AsyncHTTPTestCase
 from tornado import web
-from foodtruckapi import NearbyFoodTruckHandler, FoodTruckInfoHandler
+from foodtruckapi import NearbyFoodTruckHandler, FoodTruckInfoHandler, FoodTruckAggregateHandler
+from foodtruckschedule import parse_dayshours, parse_time, get_slot, schedule_index, ScheduleIndex, SLOTS_PER_DAY
+from foodtruckgrid import GridIndex, get_tiles, get_zoom_for_cell_size
+from datetime import datetime
+import unittest
+import pytz
 import json
 import re
 import time
@@ -11,6 +16,7 @@ class MyHTTPTest(AsyncHTTPTestCase):
     def get_app(self):
         application = web.Application([
         (r"/searchfood", NearbyFoodTruckHandler),
+        (r"/searchfood/aggregate", FoodTruckAggregateHandler),
         (r"/foodtruck", FoodTruckInfoHandler),
     ])
         return application
@@ -134,3 +140,201 @@ class MyHTTPTest(AsyncHTTPTestCase):
         response = self.wait()
         json_response = json.loads(response.body)
         self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_open_at_query(self):
+        query = '/searchfood?point=37.777863,-122.426549&radius_filter=1&limit=100'
+        self.http_client.fetch(self.get_url(query), self.stop)
+        response = self.wait()
+        all_foodtrucks = json.loads(response.body)["response"]["text"][1]
+        self.assertTrue(len(all_foodtrucks) < 100)
+        self.http_client.fetch(self.get_url(query+'&open_at=Mo%2012:00'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["response"]["text"][0], 0)
+        open_ids = [foodtruck["objectid"] for foodtruck in json_response["response"]["text"][1]]
+        self.assertTrue(open_ids)
+        slot_open_ids = set(schedule_index.open_ids(parse_time("Mo 12:00")))
+        for objectid in open_ids:
+            if objectid not in slot_open_ids:
+                self.fail("Result is not open at requested time")
+        all_ids = [foodtruck["objectid"] for foodtruck in all_foodtrucks]
+        self.assertTrue(set(open_ids) <= set(all_ids))
+        self.assertEqual(sorted(open_ids), sorted(objectid for objectid in all_ids if objectid in slot_open_ids))
+
+    def test_open_now_query(self):
+        query = '/searchfood?point=37.777863,-122.426549&radius_filter=1&limit=100'
+        slot_before = get_slot()
+        self.http_client.fetch(self.get_url(query+'&open_now=1'), self.stop)
+        response = self.wait()
+        slot_after = get_slot()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["response"]["text"][0], 0)
+        #request may cross a slot boundary
+        slot_open_ids = set(schedule_index.open_ids(slot_before)) | set(schedule_index.open_ids(slot_after))
+        for foodtruck in json_response["response"]["text"][1]:
+            if foodtruck["objectid"] not in slot_open_ids:
+                self.fail("Result is not open now")
+        self.http_client.fetch(self.get_url(query), self.stop)
+        response = self.wait()
+        all_ids = [foodtruck["objectid"] for foodtruck in json.loads(response.body)["response"]["text"][1]]
+        self.assertTrue(set(foodtruck["objectid"] for foodtruck in json_response["response"]["text"][1])
+                        <= set(all_ids))
+
+    def test_open_now_with_open_at(self):
+        self.http_client.fetch(self.get_url('/searchfood?point=37.777863,-122.426549&open_now=1&open_at=14:30'),
+                               self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_open_now_off_with_open_at(self):
+        self.http_client.fetch(self.get_url('/searchfood?point=37.777863,-122.426549&open_now=0&open_at=14:30'),
+                               self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["response"]["text"][0], 0)
+
+    def test_wrong_open_at_query(self):
+        self.http_client.fetch(self.get_url('/searchfood?point=37.777863,-122.426549&open_at=noon'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_aggregate_query(self):
+        bounds = '37.777863,-122.426549|37.790743,-122.404351'
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?bounds='+bounds+'&zoom=16&category_filter=Truck'),
+                               self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["response"]["text"][0], 0)
+        self.assertEqual(json_response["response"]["text"][1]["zoom"], 16)
+        cells = json_response["response"]["text"][1]["cells"]
+        self.assertTrue(cells)
+        #cells are whole grid cells, compare each one against a search of its own bounds
+        for cell in cells:
+            self.assertTrue(cell["count"] < 100)
+            self.http_client.fetch(self.get_url('/searchfood?bounds='+cell["bounds"]+'&limit=100&category_filter=Truck'),
+                                   self.stop)
+            response = self.wait()
+            search_response = json.loads(response.body)
+            self.assertEqual(cell["count"], len(search_response["response"]["text"][1]))
+
+    def test_aggregate_single_corner_bounds(self):
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?bounds=37.777863,-122.426549'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_aggregate_bounds_with_point(self):
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?bounds=37.777863,-122.426549|37.790743,-122.404351'
+                                            '&point=37.7,-122.4'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_aggregate_wrong_fooditems(self):
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?bounds=37.777863,-122.426549|37.790743,-122.404351'
+                                            '&fooditems=taco('), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+    def test_aggregate_missing_bounds(self):
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?zoom=14'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1001)
+
+    def test_aggregate_wrong_zoom(self):
+        self.http_client.fetch(self.get_url('/searchfood/aggregate?bounds=37.777863,-122.426549|37.790743,-122.404351'
+                                            '&zoom=99'), self.stop)
+        response = self.wait()
+        json_response = json.loads(response.body)
+        self.assertEqual(json_response["error"]["text"][0], 1002)
+
+
+class ScheduleTest(unittest.TestCase):
+    def test_parse_dayshours(self):
+        bitmap = parse_dayshours("Mo-We:10AM-2PM;Sa/Su:6PM-2AM")
+        self.assertTrue(bitmap >> parse_time("Tu 10:00") & 1)
+        self.assertTrue(bitmap >> parse_time("We 13:45") & 1)
+        self.assertFalse(bitmap >> parse_time("We 14:00") & 1)
+        self.assertFalse(bitmap >> parse_time("Th 12:00") & 1)
+        #overnight hours spill into the next day
+        self.assertTrue(bitmap >> parse_time("Su 01:30") & 1)
+        self.assertTrue(bitmap >> parse_time("Mo 01:30") & 1)
+        self.assertFalse(bitmap >> parse_time("Sa 01:30") & 1)
+
+    def test_parse_dayshours_all_day(self):
+        self.assertEqual(parse_dayshours("Mo-Su:12AM-12AM"), (1 << 7 * SLOTS_PER_DAY) - 1)
+
+    def test_parse_time(self):
+        monday = pytz.timezone("America/Los_Angeles").localize(datetime(2014, 3, 10))
+        self.assertEqual(parse_time("00:15", monday), 1)
+        self.assertEqual(parse_time("Tu 00:00", monday), SLOTS_PER_DAY)
+        self.assertRaises(ValueError, parse_time, "25:00")
+
+    def test_san_francisco_time(self):
+        #Tuesday 03:00 UTC is still Monday 20:00 in San Francisco (PDT)
+        tuesday_utc = pytz.utc.localize(datetime(2014, 3, 11, 3, 0))
+        self.assertEqual(get_slot(tuesday_utc), 20 * 4)
+        self.assertEqual(parse_time("12:00", tuesday_utc), 12 * 4)
+        #PST in winter
+        self.assertEqual(get_slot(pytz.utc.localize(datetime(2014, 1, 6, 20, 0))), 12 * 4)
+
+    def test_open_ids(self):
+        class FoodTruckCollection(object):
+            def find(self, *args):
+                return [{"objectid": "1", "dayshours": "Mo:10AM-11AM"}, {"objectid": "2", "dayshours": "Mo-Su:6AM-8PM"},
+                        {"objectid": "3"}]
+        index = ScheduleIndex()
+        index.load(FoodTruckCollection())
+        self.assertEqual(sorted(index.open_ids(parse_time("Mo 10:30"))), ["1", "2"])
+        self.assertEqual(index.open_ids(parse_time("Tu 10:30")), ["2"])
+        self.assertEqual(index.open_ids(parse_time("Mo 22:00")), [])
+
+
+class GridTest(unittest.TestCase):
+    class FoodTruckCollection(object):
+        def find(self, *args):
+            return [
+                {"loc": [-122.41, 37.78], "facilitytype": "Truck", "status": "APPROVED", "fooditems": "Tacos"},
+                {"loc": [-122.41, 37.78], "facilitytype": "Push Cart", "status": "APPROVED", "fooditems": "Hot dogs"},
+                {"loc": [-122.39, 37.76], "facilitytype": "Truck", "status": "EXPIRED", "fooditems": "Tacos"},
+            ]
+
+    def setUp(self):
+        self.grid = GridIndex()
+        self.grid.load(self.FoodTruckCollection())
+
+    def aggregate(self, zoom, **filters):
+        tiles, cell_range = get_tiles({0: 37.7, 1: 37.8}, {0: -122.5, 1: -122.3}, zoom)
+        return [cell for tile in tiles for cell in self.grid.aggregate_tile(zoom, tile, **filters)]
+
+    def test_aggregate_counts(self):
+        cells = self.aggregate(0)
+        self.assertEqual(len(cells), 1)
+        self.assertEqual(cells[0]["count"], 3)
+        self.assertAlmostEqual(cells[0]["centroid"][0], (-122.41 * 2 - 122.39) / 3)
+        self.assertEqual(len(self.aggregate(16)), 2)
+
+    def test_aggregate_filters(self):
+        self.assertEqual(sum(cell["count"] for cell in self.aggregate(16, category_filter="Truck")), 2)
+        self.assertEqual(sum(cell["count"] for cell in self.aggregate(16, status="APPROVED")), 2)
+        self.assertEqual(sum(cell["count"] for cell in self.aggregate(16, fooditems_regex=re.compile("taco", re.I),
+                                                                      status="EXPIRED")), 1)
+
+    def test_version_depends_on_data(self):
+        grid = GridIndex()
+        grid.load(self.FoodTruckCollection())
+        self.assertEqual(grid.version, self.grid.version)
+
+        class ChangedFoodTruckCollection(object):
+            def find(self, *args):
+                return GridTest.FoodTruckCollection().find()[:2]
+        grid.load(ChangedFoodTruckCollection())
+        self.assertNotEqual(grid.version, self.grid.version)
+
+    def test_zoom_for_cell_size(self):
+        self.assertEqual(get_zoom_for_cell_size(360), 0)
+        self.assertEqual(get_zoom_for_cell_size(0.01), 16)